@@ -1,16 +1,47 @@
 #!/usr/bin/env python3
 import sys
 import os
+import json
 import logging
-from optparse import OptionParser, OptionGroup
+from optparse import OptionParser, OptionGroup, Values
 import luastyle
-from luastyle.core import FilesProcessor, Configuration
+from luastyle.core import FilesProcessor, StreamProcessor, Configuration, collect_files, parse_shard, \
+    shard_files, merge_stats, format_stats
 from luastyle.indenter import IndentOptions
+from luastyle.watch import Watcher
 
 
-def abort(msg):
+# IndentOptions attributes set by each style option
+STRICT_ATTRIBUTES = ['check_space_before_line_comment_text', 'check_param_list', 'check_field_list',
+                     'skip_semi_colon', 'if_cont_line_level', 'break_if_statement', 'break_for_statement',
+                     'break_while_statement', 'force_func_call_space_checking']
+STYLE_ATTRIBUTES = {
+    'space_around_assign': ['space_around_assign'],
+    'indent_char': ['indent_char'],
+    'check_field_list': ['check_field_list'],
+    'initial_indent_level': ['initial_indent_level'],
+    'check_param_list': ['check_param_list'],
+    'indent_size': ['indent_size'],
+    'indent_with_tabs': ['indent_with_tabs'],
+    'close_on_lowest_level': ['close_on_lowest_level'],
+    'func_cont_level': ['func_cont_line_level'],
+    'if_cont_line_level': ['if_cont_line_level'],
+    'check_space_before_line_comment_text': ['check_space_before_line_comment_text'],
+    'space_before_line_comment_text': ['space_before_line_comment_text'],
+    'skip_semi_colon': ['skip_semi_colon'],
+    'break_if_statement': ['break_if_statement'],
+    'break_for_statement': ['break_for_statement'],
+    'break_while_statement': ['break_while_statement'],
+    'break_all_statement': ['break_if_statement', 'break_for_statement', 'break_while_statement'],
+    'force_func_call_space_checking': ['force_func_call_space_checking'],
+    'func_call_space_n': ['func_call_space_n'],
+    'strict': STRICT_ATTRIBUTES,
+}
+
+
+def abort(msg, status=0):
     sys.stderr.write(msg + '\n')
-    sys.exit()
+    sys.exit(status)
 
 
 def main():
@@ -23,6 +54,35 @@ def main():
                          dest='replace',
                          help='write output in-place, replacing input',
                          default=False)
+    cli_group.add_option('--check',
+                         action='store_true',
+                         dest='check',
+                         help='do not write anything, report files that would be reformatted '
+                              'and exit with a non-zero status if any',
+                         default=False)
+    cli_group.add_option('--fail-fast',
+                         action='store_true',
+                         dest='fail_fast',
+                         help='stop on the first file that would be reformatted or could not be '
+                              'formatted in check mode, or on the first bytecode error',
+                         default=False)
+    cli_group.add_option('--headers',
+                         action='store_const',
+                         const='header',
+                         dest='output_format',
+                         help='write a header before the output of each file',
+                         default='text')
+    cli_group.add_option('--diff',
+                         action='store_const',
+                         const='diff',
+                         dest='output_format',
+                         help='write a unified diff instead of the output of each file')
+    cli_group.add_option('--edits',
+                         action='store_const',
+                         const='edits',
+                         dest='output_format',
+                         help='write a json line with the list of [offset, length, replacement] edits '
+                              'of each file instead of its output')
     cli_group.add_option('--config',
                          metavar='F', type='string',
                          dest='config_file',
@@ -32,6 +92,11 @@ def main():
                          dest='config_generate',
                          help='generate a default config file',
                          default=False)
+    cli_group.add_option('--no-config-lookup',
+                         action='store_false',
+                         dest='config_lookup',
+                         help='do not look for .luastylerc files in the directories of the processed files',
+                         default=True)
     cli_group.add_option('--type',
                          action="append",
                          type='string',
@@ -59,6 +124,35 @@ def main():
                          dest='check_bytecode',
                          help='check lua bytecode with luac, $LUAC can also be set to use a specific compiler',
                          default=False)
+    cli_group.add_option('-w', '--watch',
+                         action='store_true',
+                         dest='watch',
+                         help='keep running and reformat files as they change',
+                         default=False)
+    cli_group.add_option('--shard',
+                         metavar='I/N', type='string',
+                         dest='shard',
+                         help='only process the I-th of N size-balanced shards of the file list')
+    cli_group.add_option('--stats-json',
+                         metavar='F', type='string',
+                         dest='stats_json',
+                         help='write run statistics to a json file')
+    cli_group.add_option('--merge-stats',
+                         action='store_true',
+                         dest='merge_stats',
+                         help='print a summary of the statistics json files given as arguments',
+                         default=False)
+    cli_group.add_option('--stdin',
+                         action='store_true',
+                         dest='stdin',
+                         help='filter mode, format framed documents from stdin to stdout',
+                         default=False)
+    cli_group.add_option('--framing',
+                         metavar='F', type='choice',
+                         choices=StreamProcessor.FRAMINGS,
+                         dest='framing',
+                         help='document framing in filter mode: length or nul [length]',
+                         default='length')
     parser.add_option_group(cli_group)
 
     # Style options:
@@ -175,6 +269,11 @@ def main():
     parser.add_option_group(style_group)
 
     (options, args) = parser.parse_args()
+    # without defaults, only the options given on the command line are set
+    given_options = vars(parser.parse_args(values=Values())[0])
+
+    if len(options.indent_char) != 1:
+        parser.error('--indent-char must be a single character')
 
     # generate config
     if options.config_generate:
@@ -182,9 +281,31 @@ def main():
         sys.exit()
 
     # check argument:
-    if not len(args) > 0:
+    if not len(args) > 0 and not options.stdin:
         abort('Expected a filepath or a directory path')
 
+    # merge statistics of several runs
+    if options.merge_stats:
+        try:
+            stats_list = []
+            for filepath in args:
+                with open(filepath) as file:
+                    stats_list.append(json.load(file))
+        except Exception as e:
+            abort('Error while reading statistics: ' + str(e), 1)
+        stats = merge_stats(stats_list)
+        print(format_stats(stats))
+        # files that would be reformatted fail check runs
+        check = any(run_stats.get('check', False) for run_stats in stats_list)
+        sys.exit(1 if stats['errors'] or (check and stats['changed']) else 0)
+
+    shard = None
+    if options.shard:
+        try:
+            shard = parse_shard(options.shard)
+        except ValueError as e:
+            abort(str(e), 1)
+
     # handle options:
     if options.debug:
         logging.basicConfig(level=logging.DEBUG, format='%(levelname)s:\t%(message)s')
@@ -193,6 +314,8 @@ def main():
 
     # Configuration from file or cli
     indent_options = None
+    # attributes set by style options, they override .luastylerc files
+    config_overrides = {}
     # Try to load a config file from default location
     default_filepath = [os.path.join(os.path.expanduser('~'), '.luastylerc')]
     env_var = os.environ.get('LUASTYLE_CONF')
@@ -202,7 +325,9 @@ def main():
         if os.path.exists(filepath):  # try to load existing file
             try:
                 indent_options = Configuration().load(filepath)
-                print('Configuration successfully loaded from ' + filepath)
+                # do not mix messages with formatted sources
+                print('Configuration successfully loaded from ' + filepath,
+                      file=sys.stdout if options.replace and not options.check else sys.stderr)
                 break
             except Exception as e:
                 abort('Error while reading ' + filepath + ': ' + str(e))
@@ -218,7 +343,7 @@ def main():
     else:
         indent_options = IndentOptions()
         indent_options.indent_size = options.indent_size
-        indent_options.indent_char = options.indent_char
+        indent_options.indent_char = ord(options.indent_char)
         indent_options.indent_with_tabs = options.indent_with_tabs
         indent_options.initial_indent_level = options.initial_indent_level
 
@@ -241,24 +366,66 @@ def main():
         indent_options.force_func_call_space_checking = options.force_func_call_space_checking or options.strict
         indent_options.func_call_space_n = options.func_call_space_n
 
+        attributes = json.loads(indent_options.to_json())
+        for dest, names in STYLE_ATTRIBUTES.items():
+            if dest in given_options:
+                config_overrides.update((name, attributes[name]) for name in names)
+
+    # filter mode
+    if options.stdin:
+        try:
+            errors = StreamProcessor(options.jobs,
+                                     options.check_bytecode,
+                                     indent_options,
+                                     options.framing,
+                                     options.verbose).run(sys.stdin.buffer, sys.stdout.buffer)
+        except ValueError as e:
+            abort('Error while reading stdin: ' + str(e), 1)
+        except OSError as e:
+            # stdout is gone, do not fail again when flushing it at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            abort('Error while writing stdout: ' + str(e), 1)
+        sys.exit(1 if errors else 0)
+
+    processor = FilesProcessor(options.replace,
+                               options.jobs,
+                               options.check_bytecode,
+                               indent_options,
+                               options.verbose,
+                               options.output_format,
+                               options.check,
+                               options.fail_fast,
+                               options.config_lookup,
+                               config_overrides)
+
+    # watch mode
+    if options.watch:
+        try:
+            Watcher(processor, args, options.extensions, options.jobs).run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
     # build a filename list
-    filenames = []
-    for fn_or_fp in args:
-        if not os.path.isdir(fn_or_fp):
-            filenames.append(fn_or_fp)
-        else:
-            for root, subdirs, files in os.walk(fn_or_fp):
-                for filename in files:
-                    if not options.extensions or filename.endswith(tuple(options.extensions)):
-                        filepath = os.path.join(root, filename)
-                        filenames.append(filepath)
+    filenames = collect_files(args, options.extensions)
+    if shard:
+        filenames = shard_files(filenames, *shard)
 
     # process files
-    FilesProcessor(options.replace,
-                   options.jobs,
-                   options.check_bytecode,
-                   indent_options,
-                   options.verbose).run(filenames)
+    try:
+        stats = processor.run(filenames)
+    except OSError as e:
+        # stdout is gone, do not fail again when flushing it at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        abort('Error while writing stdout: ' + str(e), 1)
+    if options.stats_json:
+        if shard:
+            stats['shard'] = options.shard
+        stats['check'] = options.check
+        with open(options.stats_json, 'w') as file:
+            json.dump(stats, file, sort_keys=True, indent=4)
+    if options.check:
+        sys.exit(1 if stats['changed'] or stats['errors'] else 0)
 
 
 if __name__ == '__main__':
@@ -1,11 +1,21 @@
+import io
 import os
 import sys
+import json
+import shutil
+import difflib
+import hashlib
+import collections
+import multiprocessing
 import time
+import heapq
+import queue
+import threading
 import subprocess
 import concurrent.futures
 from tempfile import mkstemp
 
-from luastyle.indenter import IndentRule, IndentOptions
+from luastyle.indenter import IndentRule, IndentOptions, apply_edits
 
 
 class BytecodeException(Exception):
@@ -27,73 +37,770 @@ class Configuration:
         print('Config. file generated in: ' + os.path.abspath(filepath))
 
 
+class ConfigResolver:
+    """Resolve the options of files from the .luastylerc files of their directories.
+
+    Each .luastylerc found in a directory or one of its parents overrides the
+    attributes of the ones above it, on top of the base options. Resolution
+    is cached per directory and option sets with the same content share the
+    same id, an index in the options list. An invalid .luastylerc fails the
+    files of its directory and sub-directories only.
+
+    The overrides attributes (e.g. style options given on the command line)
+    take precedence over every .luastylerc file.
+    """
+    FILENAME = '.luastylerc'
+
+    def __init__(self, base_options, overrides=None):
+        self._base = json.loads(base_options.to_json())
+        self._overrides = overrides or {}
+        self.options = []
+        self._ids = {}  # content hash -> option set id
+        self._dirs = {}  # directory -> (attributes, option set id) or ValueError
+        # the one in the user directory is the global configuration, not a per-directory one
+        self._excluded = os.path.join(os.path.expanduser('~'), self.FILENAME)
+        self._intern(self._base)
+
+    def _intern(self, attributes):
+        content = json.dumps(attributes, sort_keys=True)
+        key = hashlib.sha1(content.encode('UTF-8')).digest()
+        if key not in self._ids:
+            self.options.append(IndentOptions.from_json(content))
+            self._ids[key] = len(self.options) - 1
+        return self._ids[key]
+
+    def _resolve_dir(self, directory):
+        if directory not in self._dirs:
+            try:
+                self._dirs[directory] = self._load_dir(directory)
+            except ValueError as e:
+                self._dirs[directory] = e
+        if isinstance(self._dirs[directory], ValueError):
+            raise self._dirs[directory]
+        return self._dirs[directory]
+
+    def _load_dir(self, directory):
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            attributes = self._base
+        else:
+            attributes = self._resolve_dir(parent)[0]
+
+        filepath = os.path.join(directory, self.FILENAME)
+        if filepath == self._excluded or not os.path.isfile(filepath):
+            return attributes, self._intern(attributes)
+        try:
+            with open(filepath) as json_data_file:
+                overrides = json.load(json_data_file)
+            if not isinstance(overrides, dict):
+                raise ValueError('expecting a json object')
+            attributes = dict(attributes, **overrides)
+            attributes.update(self._overrides)
+            return attributes, self._intern(attributes)
+        except Exception as e:
+            raise ValueError('Error while reading ' + filepath + ': ' + str(e))
+
+    def invalidate(self):
+        """Forget the resolved directories, .luastylerc files are read again.
+
+        Option set ids already given stay valid.
+        """
+        self._dirs.clear()
+
+    def resolve(self, filepath):
+        """Return the option set id of a file.
+        """
+        return self._resolve_dir(os.path.dirname(os.path.abspath(filepath)))[1]
+
+
+# Representative source formatted before workers are started, it should
+# contain most of the lexical elements of the language.
+WARM_UP_SOURCE = """#!/usr/bin/env lua
+--[[ long
+comment ]]
+local M = {name = "m", ['key'] = 'value', [[long string]], 0x1F, 1.5e3, 0x1p4; nil, true, false}
+
+-- line comment
+local function f(a, b, ...)
+  local t = {...}
+  if a == b and a ~= nil or not b then
+    return a + b - 1 * 2 / 3 // 4 % 5 ^ 6, #t, a .. b
+  elseif a <= b or a >= b or a < b or a > b then
+    return a & b | ~a << 1 >> 2
+  else
+    return -a
+  end
+end
+
+for i = 1, 10, 2 do print(i) end
+for k, v in pairs(M) do M[k] = v end
+while false do break end
+repeat local x = 1 until x
+do goto done end
+::done::
+M.f = function(self) return self:f():g "s" {1} end;
+return M
+"""
+
+
+def warm_up():
+    """Import the lexer and build its antlr caches by formatting a representative source.
+
+    Returns the elapsed time in seconds.
+    """
+    start = time.time()
+    IndentRule(IndentOptions()).apply(WARM_UP_SOURCE)
+    return time.time() - start
+
+
+# FilesProcessor of the worker processes, see create_executor
+_processor = None
+
+
+def _init_worker(verbose, processor, forked):
+    global _processor
+    _processor = processor
+    # a forked worker is already warm, it is only measured in verbose mode
+    if verbose or not forked:
+        elapsed = warm_up()
+        if verbose:
+            sys.stderr.write('worker %d warm-up in %.1f ms\n' % (os.getpid(), elapsed * 1000))
+
+
+def _process_file(filepath, options_id, options):
+    return _processor._process_one(filepath, options_id, options)
+
+
+def create_executor(jobs, verbose=False, processor=None):
+    """Create a process pool whose workers start from a warmed up state.
+
+    The parent process warms up the lexer before the workers are created.
+    Where fork is available, workers inherit the imported modules and antlr
+    caches copy-on-write and skip their own warm-up, which is then only run
+    in verbose mode to measure the saving.
+
+    The given FilesProcessor is sent once to each worker, its files can
+    then be submitted with only their path and option set id.
+    """
+    if processor is not None:
+        processor.share()
+
+    elapsed = warm_up()
+    if verbose:
+        sys.stderr.write('parent warm-up in %.1f ms\n' % (elapsed * 1000))
+
+    if sys.platform.startswith('linux'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    forked = context.get_start_method() == 'fork'
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                                                      initializer=_init_worker,
+                                                      initargs=(verbose, processor, forked))
+    # with fork, all workers are started on the first submit: do it now,
+    # before the caller starts any thread
+    executor.submit(os.getpid).result()
+    return executor
+
+
+def has_extension(filename, extensions):
+    return not extensions or filename.endswith(tuple(extensions))
+
+
+def collect_files(paths, extensions):
+    """Build the list of files to process from a list of files or directories.
+
+    Directories are walked recursively and only files matching one of the
+    given extensions are kept.
+    """
+    filenames = []
+    for fn_or_fp in paths:
+        if not os.path.isdir(fn_or_fp):
+            filenames.append(fn_or_fp)
+        else:
+            for root, subdirs, files in os.walk(fn_or_fp):
+                # do not depend on the file system order
+                subdirs.sort()
+                for filename in sorted(files):
+                    if has_extension(filename, extensions):
+                        filepath = os.path.join(root, filename)
+                        filenames.append(filepath)
+    return filenames
+
+
+def decode_source(data):
+    """Decode file content like a file opened in text mode."""
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+def encode_source(text):
+    """Encode text like a file opened in text mode."""
+    buffer = io.BytesIO()
+    wrapper = io.TextIOWrapper(buffer)
+    wrapper.write(text)
+    wrapper.flush()
+    return buffer.getvalue()
+
+
+def first_changed_line(raw, formatted):
+    """Return the number (1-based) of the first line that differs, None if equal.
+    """
+    if raw == formatted:
+        return None
+    for n, (raw_line, formatted_line) in enumerate(zip(raw.splitlines(True), formatted.splitlines(True)), 1):
+        if raw_line != formatted_line:
+            return n
+    # one is a prefix of the other
+    return min(raw.count('\n'), formatted.count('\n')) + 1
+
+
+def parse_shard(shard):
+    """Parse a "i/N" shard specification, i is in [1, N].
+    """
+    try:
+        index, count = (int(n) for n in shard.split('/'))
+    except ValueError:
+        raise ValueError('invalid shard, expected i/N: ' + shard)
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError('invalid shard, expected 1 <= i <= N: ' + shard)
+    return index, count
+
+
+def shard_files(files, index, count):
+    """Return the files of the shard index (1-based) out of count shards.
+
+    Files are spread over shards by size, biggest first, each one going to
+    the least loaded shard. Ties are broken by path so that every node
+    computes the same partition whatever the order of the given list.
+    """
+    sizes = {}
+    for filepath in files:
+        try:
+            sizes[filepath] = os.path.getsize(filepath)
+        except OSError:
+            sizes[filepath] = 0
+
+    # (load, shard index) heap
+    loads = [(0, i) for i in range(count)]
+    shard = []
+    for filepath in sorted(sizes, key=lambda f: (-sizes[f], f)):
+        load, i = heapq.heappop(loads)
+        if i == index - 1:
+            shard.append(filepath)
+        heapq.heappush(loads, (load + sizes[filepath], i))
+    return sorted(shard)
+
+
+def merge_stats(stats_list):
+    """Merge statistics returned by several runs (for example one per shard).
+    """
+    merged = {'files': 0, 'processed': 0, 'changed': 0, 'errors': 0, 'lines': 0, 'time': 0.0}
+    for stats in stats_list:
+        for key in merged:
+            merged[key] += stats.get(key, 0)
+    return merged
+
+
+def format_stats(stats):
+    return '%d/%d file(s) processed, %d changed, %d error(s), %d source lines in %s s' % (
+        stats['processed'], stats['files'], stats['changed'], stats['errors'], stats['lines'],
+        round(stats['time'], 2))
+
+
+class LargeOutput:
+    """Output too large to be pickled back from a worker, spooled to a temporary file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+
 class FilesProcessor:
-    def __init__(self, rewrite, jobs, check_bytecode, indent_options, verbose):
+    OUTPUT_FORMATS = ('text', 'header', 'diff', 'edits')
+    # outputs bigger than this are streamed through a temporary file
+    LARGE_OUTPUT_SIZE = 4 * 1024 * 1024
+    OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, rewrite, jobs, check_bytecode, indent_options, verbose, output_format='text',
+                 check=False, fail_fast=False, config_lookup=False, config_overrides=None):
+        if output_format not in self.OUTPUT_FORMATS:
+            raise ValueError('unknown output format: ' + output_format)
         self._rewrite = rewrite
         self._jobs = jobs
         self._check_bytecode = check_bytecode
         self._indent_options = indent_options
         self.verbose = verbose
+        self._output_format = output_format
+        # only report files that would be changed
+        self._check = check
+        # stop on the first changed file in check mode or on the first bytecode error
+        self._fail_fast = fail_fast
+        # per-directory options
+        if config_lookup:
+            self._resolver = ConfigResolver(indent_options, config_overrides)
+            self._options = self._resolver.options
+        else:
+            self._resolver = None
+            self._options = [indent_options]
+        # number of option sets known by the workers
+        self._shared_options = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the directory cache is only needed in the parent process
+        state['_resolver'] = None
+        return state
+
+    def share(self):
+        """Called before sending this processor to worker processes.
+        """
+        self._shared_options = len(self._options)
+
+    def resolve(self, files, errors=None):
+        """Resolve the option set of files, return their ids.
+
+        The id of a file whose configuration could not be read is None, the
+        error messages are appended to errors.
+        """
+        if self._resolver is None:
+            return [0] * len(files)
+        options_ids = []
+        for file in files:
+            try:
+                options_ids.append(self._resolver.resolve(file))
+            except ValueError as e:
+                options_ids.append(None)
+                if errors is not None and str(e) not in errors:
+                    errors.append(str(e))
+        return options_ids
+
+    def reload_config(self):
+        """Read the .luastylerc files again on the next resolution.
+        """
+        if self._resolver is not None:
+            self._resolver.invalidate()
+
+    def _submit(self, executor, file, options_id):
+        # option sets unknown by the workers are sent along
+        if options_id < self._shared_options:
+            options = None
+        else:
+            options = self._options[options_id]
+        return executor.submit(_process_file, file, options_id, options)
+
+    def _render(self, filepath, rule_input, rule_output):
+        """Render the output of one file in the configured output format.
+        """
+        if self._output_format == 'text':
+            return rule_output + '\n'
+        elif self._output_format == 'header':
+            if rule_output and not rule_output.endswith('\n'):
+                rule_output += '\n'
+            return '==> ' + filepath + ' <==\n' + rule_output
+        else:
+            lines = difflib.unified_diff(rule_input.splitlines(True), rule_output.splitlines(True),
+                                         filepath, filepath)
+            return ''.join(line if line.endswith('\n') else line + '\n\\ No newline at end of file\n'
+                           for line in lines)
+
+    def _ship(self, output):
+        """Prepare an output to be sent back to the parent process.
+        """
+        data = output.encode('UTF-8')
+        if len(data) <= self.LARGE_OUTPUT_SIZE:
+            return data
+
+        fd, path = mkstemp(prefix='luastyle-')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        return LargeOutput(path)
 
-    def _process_one(self, filepath):
+    def _process_one(self, filepath, options_id=0, options=None):
         """Process one file.
+
+        In rewrite mode, the file is written in place if changed, in check
+        mode nothing is written, else its output is returned to be written by
+        the parent process. The first changed line is returned in all modes,
+        None if the file is unchanged, and so is the digest of the file
+        content, as written or as read.
         """
-        with open(filepath) as file:
-            rule_input = file.read()
+        with open(filepath, 'rb') as file:
+            data = file.read()
+        digest = hashlib.sha1(data).digest()
+        rule_input = decode_source(data)
 
-        rule_output = IndentRule(self._indent_options).apply(rule_input)
+        if options is None:
+            options = self._options[options_id]
+
+        if self._output_format == 'edits' and not self._rewrite and not self._check:
+            return self._process_edits(filepath, rule_input, options) + (digest,)
+
+        rule_output = IndentRule(options).apply(rule_input)
 
         if self._check_bytecode:
             bytecode_equal = check_lua_bytecode(rule_input, rule_output)
         else:
             bytecode_equal = True
 
-        if bytecode_equal:
+        changed_line = first_changed_line(rule_input, rule_output)
+
+        output = None
+        if bytecode_equal and not self._check:
             if self._rewrite:
-                f = open(filepath, 'r+')
-                f.seek(0)
-                f.write(rule_output)
-                f.truncate()
-                f.close()
+                if changed_line is not None:
+                    data = encode_source(rule_output)
+                    digest = hashlib.sha1(data).digest()
+                    f = open(filepath, 'r+b')
+                    f.write(data)
+                    f.truncate()
+                    f.close()
             else:
-                print(rule_output)
+                output = self._ship(self._render(filepath, rule_input, rule_output))
+
+        return bytecode_equal, len(rule_output.split('\n')), output, changed_line, digest
+
+    def _process_edits(self, filepath, rule_input, options):
+        """Process one file in edits output format.
+
+        Only the list of edits is computed, the output is a json line
+        {"file": filepath, "edits": [[offset, length, replacement], ...]}.
+        """
+        edits = IndentRule(options).edits(rule_input)
+
+        if self._check_bytecode:
+            bytecode_equal = check_lua_bytecode(rule_input, apply_edits(rule_input, edits))
+        else:
+            bytecode_equal = True
+
+        if edits:
+            changed_line = rule_input.count('\n', 0, edits[0][0]) + 1
+        else:
+            changed_line = None
+
+        output = None
+        if bytecode_equal:
+            output = self._ship(json.dumps({'file': filepath, 'edits': edits}) + '\n')
+
+        return bytecode_equal, len(rule_input.split('\n')), output, changed_line
 
-        return bytecode_equal, len(rule_output.split('\n'))
+    def _discard(self, future):
+        """Done callback of a future whose result is not used.
+        """
+        if not future.cancelled() and future.exception() is None:
+            output = future.result()[2]
+            if isinstance(output, LargeOutput):
+                os.remove(output.path)
+
+    def _write_output(self, outstream, output):
+        if isinstance(output, LargeOutput):
+            try:
+                with open(output.path, 'rb') as file:
+                    shutil.copyfileobj(file, outstream, self.OUTPUT_BUFFER_SIZE)
+            finally:
+                os.remove(output.path)
+        else:
+            outstream.write(output)
+
+    def _results(self, executor, files):
+        """Submit (file, option set id) pairs and yield (file, future) pairs.
+
+        In rewrite and check mode, futures are yielded as they complete. Else
+        they are yielded in the files order, the number of futures in flight
+        is bounded so that pending outputs do not pile up in memory.
+
+        If the generator is closed early, pending futures are cancelled.
+        """
+        if self._rewrite or self._check:
+            future_to_file = {self._submit(executor, file, options_id): file for file, options_id in files}
+            pending = set(future_to_file)
+            try:
+                for future in concurrent.futures.as_completed(future_to_file):
+                    pending.discard(future)
+                    yield future_to_file[future], future
+            finally:
+                self._cancel(pending)
+        else:
+            window = self._jobs * 4
+            pending = collections.deque()
+            try:
+                for file, options_id in files:
+                    pending.append((file, self._submit(executor, file, options_id)))
+                    if len(pending) >= window:
+                        yield pending.popleft()
+                while pending:
+                    yield pending.popleft()
+            finally:
+                self._cancel(future for file, future in pending)
+
+    def _cancel(self, futures):
+        for future in futures:
+            # running futures can not be cancelled, drop their result
+            if not future.cancel():
+                future.add_done_callback(self._discard)
+
+    def run(self, files, executor=None, outstream=None, digests=None):
+        """Process files on the given executor, a new process pool is created if None.
+
+        The executor must have been created by create_executor with this processor.
+
+        Outputs are written in the files order to outstream (a binary stream,
+        stdout by default) when not in rewrite mode. Messages are written to
+        stderr in this case.
+
+        If digests is a dict, it receives the sha1 digest of the content of
+        each processed file, as written or as read by the worker.
+
+        Returns a dict of statistics, see merge_stats. Raises OSError if the
+        output could not be written.
+        """
+        if executor is None:
+            # resolve the option sets before the workers receive them
+            self.resolve(files)
+            # We can use a with statement to ensure threads are cleaned up promptly
+            with create_executor(self._jobs, self.verbose, self) as executor:
+                return self.run(files, executor, outstream, digests)
+
+        if self._rewrite:
+            log = sys.stdout
+        elif self._check:
+            log = sys.stderr
+        else:
+            log = sys.stderr
+            if outstream is None:
+                sys.stdout.flush()
+                outstream = io.open(sys.stdout.fileno(), 'wb', buffering=self.OUTPUT_BUFFER_SIZE, closefd=False)
 
-    def run(self, files):
         if self.verbose:
-            print(str(len(files)) + ' file(s) to process')
+            print(str(len(files)) + ' file(s) to process', file=log)
+
+        config_errors = []
+        options_ids = self.resolve(files, config_errors)
+        for message in config_errors:
+            print(message, file=log)
+        # files whose configuration is invalid are not processed
+        errors = options_ids.count(None)
+        resolved = [(file, options_id) for file, options_id in zip(files, options_ids) if options_id is not None]
 
         processed = 0
+        changed = 0
         if self.verbose:
-            print('[' + str(processed) + '/' + str(len(files)) + '] file(s) processed')
+            print('[' + str(processed) + '/' + str(len(files)) + '] file(s) processed', file=log)
 
         # some stats
         start = time.time()
         total_lines = 0
 
-        # We can use a with statement to ensure threads are cleaned up promptly
-        with concurrent.futures.ProcessPoolExecutor(max_workers=self._jobs) as executor:
-            # Start process operations and mark each future with its filename
-            future_to_file = {executor.submit(self._process_one, file): file for file in files}
-            for future in concurrent.futures.as_completed(future_to_file):
-                file = future_to_file[future]
+        if self.verbose and self._resolver is not None:
+            print(str(len(set(options_id for file, options_id in resolved))) + ' option set(s) used', file=log)
+
+        results = self._results(executor, resolved)
+        try:
+            for file, future in results:
                 try:
-                    success, n_lines = future.result()
+                    success, n_lines, output, changed_line, digest = future.result()
                     total_lines += n_lines
+                    if digests is not None:
+                        digests[file] = digest
                     if not success:
                         raise BytecodeException('bytecode differs')
                 except Exception as exc:
-                    print('%r generated an exception: %s' % (file, exc))
+                    errors += 1
+                    print('%r generated an exception: %s' % (file, exc), file=log)
+                    # in check mode, a file that cannot be formatted is a violation too
+                    if self._fail_fast and (self._check or isinstance(exc, BytecodeException)):
+                        break
                 else:
+                    # an output error (e.g. broken pipe) is not a file error, it ends the run
+                    if output is not None:
+                        self._write_output(outstream, output)
                     processed += 1
+                    if changed_line is not None:
+                        changed += 1
+                        if self._check:
+                            print('%s:%d: would be reformatted' % (file, changed_line))
                     if self.verbose:
-                        print('[' + str(processed) + '/' + str(len(files)) + '] file(s) processed, last is ' + file)
-                    sys.stdout.flush()
+                        print('[' + str(processed) + '/' + str(len(files)) + '] file(s) processed, last is ' + file,
+                              file=log)
+                    log.flush()
+                    if self._fail_fast and self._check and changed_line is not None:
+                        break
+        finally:
+            # cancel pending files
+            results.close()
+
+        if outstream is not None:
+            outstream.flush()
+
+        end = time.time()
+        if self.verbose:
+            print(str(total_lines) + ' source lines processed in ' + str(round(end - start, 2)) + ' s', file=log)
+
+        return {'files': len(files),
+                'processed': processed,
+                'changed': changed,
+                'errors': errors,
+                'lines': total_lines,
+                'time': end - start}
+
+
+class StreamProcessor:
+    """Format a stream of framed Lua documents read from stdin.
+
+    Two framings are supported, the same one is used for input and output:
+
+    - ``length``: each document is preceded by its size in bytes written in
+      decimal and terminated by a newline (``12\\nprint('foo')``).
+      A document that failed is written as ``!<size>\\n<error message>``.
+    - ``nul``: documents are separated by a NUL byte. A document that failed
+      is written as a NAK byte (``\\x15``) followed by the error message.
+
+    Documents are formatted on the worker pool and written back in input
+    order, so a single process can serve a whole build action.
+    """
+    FRAMINGS = ('length', 'nul')
+    ERROR_MARK = b'\x15'
+
+    def __init__(self, jobs, check_bytecode, indent_options, framing='length', verbose=False):
+        if framing not in self.FRAMINGS:
+            raise ValueError('unknown framing: ' + framing)
+        self._jobs = jobs
+        self._check_bytecode = check_bytecode
+        self._indent_options = indent_options
+        self._framing = framing
+        self.verbose = verbose
+
+    def _format_one(self, document):
+        """Format one document, raise on error.
+        """
+        rule_input = document.decode('UTF-8')
+        rule_output = IndentRule(self._indent_options).apply(rule_input)
+
+        if self._check_bytecode and not check_lua_bytecode(rule_input, rule_output):
+            raise BytecodeException('bytecode differs')
+
+        return rule_output.encode('UTF-8')
+
+    def _read_length(self, instream):
+        while True:
+            header = instream.readline()
+            if not header:
+                return
+            try:
+                size = int(header)
+            except ValueError:
+                raise ValueError('invalid document header: %r' % header)
+            if size < 0:
+                raise ValueError('invalid document header: %r' % header)
+            document = instream.read(size)
+            if len(document) != size:
+                raise ValueError('truncated document, expected %d bytes got %d' % (size, len(document)))
+            yield document
+
+    def _read_nul(self, instream):
+        read = getattr(instream, 'read1', instream.read)
+        document = bytearray()
+        while True:
+            chunk = read(65536)
+            if not chunk:
+                break
+            start = 0
+            while True:
+                end = chunk.find(b'\0', start)
+                if end < 0:
+                    document += chunk[start:]
+                    break
+                document += chunk[start:end]
+                yield bytes(document)
+                document.clear()
+                start = end + 1
+        if document:
+            yield bytes(document)
+
+    def _write(self, outstream, success, payload):
+        if self._framing == 'length':
+            outstream.write((b'' if success else b'!') + str(len(payload)).encode('ascii') + b'\n')
+            outstream.write(payload)
+        else:
+            if not success:
+                outstream.write(self.ERROR_MARK)
+            outstream.write(payload)
+            outstream.write(b'\0')
+
+    def _writer(self, outstream, futures, stats):
+        try:
+            while True:
+                future = futures.get()
+                if future is None:
+                    break
+                try:
+                    success, payload = True, future.result()
+                except Exception as exc:
+                    stats['errors'] += 1
+                    success, payload = False, str(exc).encode('UTF-8')
+                self._write(outstream, success, payload)
+                stats['documents'] += 1
+                # do not keep the consumer waiting while we block on the next result
+                if futures.empty():
+                    outstream.flush()
+            outstream.flush()
+        except OSError as exc:
+            # the output is closed (e.g. broken pipe), reported by run()
+            stats['write_error'] = exc
+
+    def _put(self, futures, item, writer):
+        """Queue an item for the writer, return False if the writer is dead.
+        """
+        while writer.is_alive():
+            try:
+                futures.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _cancel(self, futures):
+        while not futures.empty():
+            future = futures.get_nowait()
+            if future is not None:
+                future.cancel()
+
+    def run(self, instream, outstream):
+        """Format documents from a binary input stream to a binary output stream.
+
+        Returns the number of documents that could not be formatted, raises
+        ValueError on a malformed input stream and OSError if the output
+        stream could not be written.
+        """
+        if self._framing == 'length':
+            documents = self._read_length(instream)
+        else:
+            documents = self._read_nul(instream)
+
+        start = time.time()
+        stats = {'documents': 0, 'errors': 0}
+        # bound the number of documents in flight, results are written in order
+        futures = queue.Queue(maxsize=self._jobs * 4)
+        writer = threading.Thread(target=self._writer, args=(outstream, futures, stats))
+
+        with create_executor(self._jobs, self.verbose) as executor:
+            writer.start()
+            try:
+                for document in documents:
+                    if not self._put(futures, executor.submit(self._format_one, document), writer):
+                        break
+            finally:
+                self._put(futures, None, writer)
+                writer.join()
+                # documents left by a dead writer
+                self._cancel(futures)
+
+        if 'write_error' in stats:
+            raise stats['write_error']
 
         end = time.time()
         if self.verbose:
-            print(str(total_lines) + ' source lines processed in ' + str(round(end - start, 2)) + ' s')
+            sys.stderr.write(str(stats['documents']) + ' document(s) processed in ' +
+                             str(round(end - start, 2)) + ' s, ' + str(stats['errors']) + ' error(s)\n')
+        return stats['errors']
 
 
 def check_lua_bytecode(raw, formatted):
@@ -151,7 +151,14 @@ cdef struct ParseTailResult:
 
 cdef struct CCommonToken:
     int type
+    # indentation and synthesized space tokens have no text, only a count
+    # of fill characters expanded on output (see write_token)
+    int count
     string text
+    # source position (character offsets), start is -1 if the token
+    # text does not come from the source as is
+    int start
+    int stop
 
 
 cdef class IndentProcessor:
@@ -175,6 +182,7 @@ cdef class IndentProcessor:
     cdef vector[bool] _is_tail_chainable_stack
     cdef vector[int] _tail_last_line_stack
     cdef vector[string] _last_tok_text_stack
+    cdef vector[int] _last_tok_count_stack
 
     cdef unordered_set[int] CLOSING_TOKEN
     cdef unordered_set[int] HIDDEN_TOKEN
@@ -186,13 +194,21 @@ cdef class IndentProcessor:
     cdef unordered_set[int] ATOM_OP
     cdef unordered_set[int] STRING_TYPES
     cdef unordered_set[int] COMMA_SEMCOL
+    cdef unordered_set[int] LITERAL
+    cdef unordered_set[int] FIELD_END
 
     cdef inline void inc_level(self, int n=1)
 
     cdef inline void dec_level(self, int n=1)
 
+    cdef int parse(self) except -1
+
     cpdef str process(self)
 
+    cpdef list process_edits(self, str source)
+
+    cdef void write_token(self, string& out, CCommonToken& token)
+
     cdef bool ws(self, int size)
 
     cdef bool ensure_newline(self)
@@ -313,6 +329,10 @@ cdef class IndentProcessor:
 
     cdef ParseFieldResult parse_field(self, int n_space_before_assign=?)
 
+    cdef int literal_field_size(self, int offset=?)
+
+    cdef ParseFieldResult parse_literal_field(self, int n_space_before_assign=?)
+
     cdef bool parse_field_sep(self)
 
     cdef inline int get_current_indent(self)
@@ -3,7 +3,9 @@ from antlr4.Token import CommonToken
 # cython import
 from libcpp cimport bool
 from libcpp.vector cimport vector
+import re
 import json
+import bisect
 from cython.operator cimport dereference as deref, predecrement as dec, preincrement as inc
 
 
@@ -105,9 +107,39 @@ cdef class IndentOptions:
         return options
 
 
-cdef inline void repeat_char(string& s, char c, int n):
-    s.resize(0)
-    s.resize(n, c)
+cdef void add_edit(list edits, str source, int start, int end, string& pending):
+    """Append the edit replacing source[start:end] by pending, trimmed to what differs."""
+    cdef str original = source[start:end]
+    cdef str replacement = pending.decode('UTF-8')
+    cdef int prefix = 0
+    cdef int suffix = 0
+    cdef int n
+
+    if original == replacement:
+        return
+
+    n = min(len(original), len(replacement))
+    while prefix < n and original[prefix] == replacement[prefix]:
+        prefix += 1
+    n -= prefix
+    while suffix < n and original[len(original) - 1 - suffix] == replacement[len(replacement) - 1 - suffix]:
+        suffix += 1
+
+    edits.append((start + prefix,
+                  len(original) - prefix - suffix,
+                  replacement[prefix:len(replacement) - suffix]))
+
+
+def apply_edits(input, edits):
+    """Apply a list of (offset, length, replacement) edits, sorted by offset."""
+    chunks = []
+    cursor = 0
+    for offset, length, replacement in edits:
+        chunks.append(input[cursor:offset])
+        chunks.append(replacement)
+        cursor = offset + length
+    chunks.append(input[cursor:])
+    return ''.join(chunks)
 
 
 cdef class IndentProcessor:
@@ -167,12 +199,31 @@ cdef class IndentProcessor:
         self.COMMA_SEMCOL.insert(CTokens.COMMA)
         self.COMMA_SEMCOL.insert(CTokens.SEMCOL)
 
+        self.LITERAL.insert(CTokens.NUMBER)
+        self.LITERAL.insert(CTokens.INT)
+        self.LITERAL.insert(CTokens.HEX)
+        self.LITERAL.insert(CTokens.FLOAT)
+        self.LITERAL.insert(CTokens.HEX_FLOAT)
+        self.LITERAL.insert(CTokens.STRING)
+        self.LITERAL.insert(CTokens.NORMALSTRING)
+        self.LITERAL.insert(CTokens.CHARSTRING)
+        self.LITERAL.insert(CTokens.LONGSTRING)
+        self.LITERAL.insert(CTokens.NIL)
+        self.LITERAL.insert(CTokens.TRUE)
+        self.LITERAL.insert(CTokens.FALSE)
+
+        self.FIELD_END.insert(CTokens.COMMA)
+        self.FIELD_END.insert(CTokens.SEMCOL)
+        self.FIELD_END.insert(CTokens.CBRACE)
+
         self.STRING_TYPES.insert(CTokens.NORMALSTRING)
         self.STRING_TYPES.insert(CTokens.CHARSTRING)
         self.STRING_TYPES.insert(CTokens.LONGSTRING)
 
         # init indentation token
         self._indentation_token.type = -2  # indentation token
+        self._indentation_token.count = 0
+        self._indentation_token.start = -1
 
         self._stream = stream
         # contains a list of CommonTokens
@@ -188,30 +239,75 @@ cdef class IndentProcessor:
         # append the first indentation token
         cdef CCommonToken t
         t.type = -2  # indentation type
-        repeat_char(t.text, self._opt.indent_char, self.get_current_indent())
+        t.count = self.get_current_indent()
+        t.start = -1
         self._src.push_back(t)
 
     cdef void inc_level(self, int n=1):
         self._level += n
-        repeat_char(self._indentation_token.text, self._opt.indent_char, self.get_current_indent())
+        self._indentation_token.count = self.get_current_indent()
 
     cdef void dec_level(self, int n=1):
         self._level -= n
-        repeat_char(self._indentation_token.text, self._opt.indent_char, self.get_current_indent())
+        self._indentation_token.count = self.get_current_indent()
 
-    cpdef str process(self):
+    cdef int parse(self) except -1:
         if self._opt.indent_with_tabs:
             self._opt.indent_char = b'\t'
 
         if not self.parse_chunk():
             raise Exception("Expecting a chunk")
+        return 0
+
+    cpdef str process(self):
+        self.parse()
 
         cdef string src
-        for token in self._src:
-            src += token.text
+        cdef size_t i
+        for i in range(self._src.size()):
+            self.write_token(src, self._src[i])
 
         return src.decode('UTF-8')
 
+    cpdef list process_edits(self, str source):
+        """Return the list of (offset, length, replacement) edits to apply on source.
+
+        Tokens copied from the source are kept, edits replace the source text
+        between two kept tokens by the text rendered in between, so only
+        the changes are collected. Offsets are in characters.
+        """
+        cdef list edits = []
+        cdef int cursor = 0
+        cdef size_t i
+        cdef CCommonToken* token
+        cdef string pending
+
+        self.parse()
+
+        for i in range(self._src.size()):
+            token = &self._src[i]
+            # tokens moved before their source position are rendered as new text
+            if token.start >= cursor:
+                if token.start > cursor or not pending.empty():
+                    add_edit(edits, source, cursor, token.start, pending)
+                    pending.clear()
+                cursor = token.stop + 1
+            else:
+                self.write_token(pending, token[0])
+
+        if <int>len(source) > cursor or not pending.empty():
+            add_edit(edits, source, cursor, len(source), pending)
+        return edits
+
+    cdef void write_token(self, string& out, CCommonToken& token):
+        """Append the text of a token, expanding its fill characters."""
+        cdef char fill = b' '
+        out.append(token.text)
+        if token.count > 0:
+            if token.type == -2:
+                fill = self._opt.indent_char
+            out.append(<size_t>token.count, fill)
+
     cdef bool ws(self, int size):
         cdef bool new_line
         cdef CCommonToken* last
@@ -222,10 +318,13 @@ cdef class IndentProcessor:
 
         if not new_line:
             if last.type == CTokens.SPACE:
-                repeat_char(last.text, b' ', size)
+                last.text.clear()
+                last.count = size
+                last.start = -1
             else:
-                repeat_char(token.text, b' ', size)
                 token.type = CTokens.SPACE
+                token.count = size
+                token.start = -1
                 self.render(token)
 
         return True
@@ -247,7 +346,9 @@ cdef class IndentProcessor:
             inc(it)
 
         token.type = CTokens.NEWLINE
+        token.count = 0
         token.text = b'\n'
+        token.start = -1
         self.render(token)
 
         return True
@@ -259,6 +360,7 @@ cdef class IndentProcessor:
         self._level_stack.push_back(self._level)
         self._right_index_stack.push_back(self._right_index)
         self._last_tok_text_stack.push_back(self._src.back().text)
+        self._last_tok_count_stack.push_back(self._src.back().count)
 
     cdef void render(self, CCommonToken& token):
         cdef vector[CCommonToken].reverse_iterator it
@@ -275,7 +377,7 @@ cdef class IndentProcessor:
                         pass  # continue
                     elif deref(it).type == -2:
                         # set on current level
-                        deref(it).text = self._indentation_token.text
+                        deref(it).count = self._indentation_token.count
                         break
                     else:
                         break
@@ -290,6 +392,7 @@ cdef class IndentProcessor:
         self._level_stack.pop_back()
         self._right_index_stack.pop_back()
         self._last_tok_text_stack.pop_back()
+        self._last_tok_count_stack.pop_back()
         #logging.debug('success ' + inspect.stack()[1][3])
         return True
 
@@ -311,8 +414,12 @@ cdef class IndentProcessor:
         self._right_index = self._right_index_stack.back()
         self._right_index_stack.pop_back()
         token = &self._src.back()
-        token.text = self._last_tok_text_stack.back()
+        if token.text != self._last_tok_text_stack.back() or token.count != self._last_tok_count_stack.back():
+            token.text = self._last_tok_text_stack.back()
+            token.count = self._last_tok_count_stack.back()
+            token.start = -1
         self._last_tok_text_stack.pop_back()
+        self._last_tok_count_stack.pop_back()
         return False
 
     cdef void failure_save(self):
@@ -327,7 +434,10 @@ cdef class IndentProcessor:
 
         py_tok = self._stream.LT(1)
         token.type = py_tok.type
+        token.count = 0
         token.text = py_tok.text.encode('UTF-8')
+        token.start = py_tok.start
+        token.stop = py_tok.stop
 
         self._right_index = self._stream.index
 
@@ -348,7 +458,10 @@ cdef class IndentProcessor:
 
         py_tok = self._stream.LT(1)
         token.type = py_tok.type
+        token.count = 0
         token.text = py_tok.text.encode('UTF-8')
+        token.start = py_tok.start
+        token.stop = py_tok.stop
         self._right_index = self._stream.index
         self._stream.consume()
         self.render(token)
@@ -364,7 +477,10 @@ cdef class IndentProcessor:
 
         py_tok = self._stream.LT(1)
         token.type = py_tok.type
+        token.count = 0
         token.text = py_tok.text.encode('UTF-8')
+        token.start = py_tok.start
+        token.stop = py_tok.stop
 
         self._right_index = self._stream.index
 
@@ -386,7 +502,10 @@ cdef class IndentProcessor:
 
         py_tok = self._stream.LT(1)
         token.type = py_tok.type
+        token.count = 0
         token.text = py_tok.text.encode('UTF-8')
+        token.start = py_tok.start
+        token.stop = py_tok.stop
         self._right_index = self._stream.index
 
         if types.find(token.type) != types.end():
@@ -429,7 +548,10 @@ cdef class IndentProcessor:
                 inc(it)
 
             tok.type = token.type
+            tok.count = 0
             tok.text = token.text.encode('UTF-8')
+            tok.start = token.start
+            tok.stop = token.stop
             self.render(tok)
             self._src.insert(self._src.end(), hidden_stack.begin(), hidden_stack.end())
 
@@ -442,7 +564,7 @@ cdef class IndentProcessor:
             it = self._src.rbegin()
             while it != self._src.rend():
                 if deref(it).type == CTokens.SPACE:
-                    space_count += deref(it).text.size()
+                    space_count += deref(it).text.size() + deref(it).count
                     tok = self._src.back()
                     self._src.pop_back()
                 else:
@@ -450,7 +572,9 @@ cdef class IndentProcessor:
                 inc(it)
 
             if space_count > 0:
-                repeat_char(tok.text, b' ', space_count)
+                tok.text.clear()
+                tok.count = space_count
+                tok.start = -1
                 self._src.push_back(tok)
 
             return True
@@ -470,7 +594,7 @@ cdef class IndentProcessor:
             if deref(it).type == CTokens.NEWLINE:
                 break
             else:
-                column += deref(it).text.size()
+                column += deref(it).text.size() + deref(it).count
             inc(it)
 
         return column
@@ -511,19 +635,18 @@ cdef class IndentProcessor:
         tokens = self._stream.getHiddenTokensToLeft(self._stream.index)
         if tokens:
             for t in tokens:
+                token.type = t.type
+                token.count = 0
+                token.text = t.text.encode('UTF-8')
+                token.start = t.start
+                token.stop = t.stop
                 if t.type == CTokens.NEWLINE:
-                    token.type = t.type
-                    token.text = t.text.encode('UTF-8')
                     self.render(token)
                     is_newline = True
                 elif t.type == CTokens.SPACE:
                     if not is_newline:
-                        token.type = t.type
-                        token.text = t.text.encode('UTF-8')
                         self.render(token)
                 else:
-                    token.type = t.type
-                    token.text = t.text.encode('UTF-8')
                     self.render(token)
                     is_newline = False
 
@@ -534,9 +657,12 @@ cdef class IndentProcessor:
         tokens = self._stream.getHiddenTokensToRight(self._right_index)
         if tokens:
             for t in tokens:
+                token.type = t.type
+                token.count = 0
+                token.start = t.start
+                token.stop = t.stop
                 # TODO: replace with a map
                 if t.type == CTokens.NEWLINE:
-                    token.type = t.type
                     token.text = t.text.encode('UTF-8')
                     self.render(token)
                     # render() pushes indentation after each newline.
@@ -553,7 +679,6 @@ cdef class IndentProcessor:
                 elif t.type == CTokens.SPACE:
                     if not is_newline:
                         if not self._src.empty():  # do not begin with a space
-                            token.type = t.type
                             token.text = t.text.encode('UTF-8')
                             self.render(token)
                 elif self._opt.check_space_before_line_comment_text and \
@@ -564,12 +689,11 @@ cdef class IndentProcessor:
                     dash_count = len(comment_text) - len(comment_witout_dash)
                     comment_text = comment_witout_dash.lstrip()
                     comment_text = '-' * dash_count + self._opt.space_before_line_comment_text * ' ' + comment_text
-                    token.type = t.type
                     token.text = comment_text.encode('UTF-8')
+                    token.start = -1
                     self.render(token)
                     is_newline = False
                 else:
-                    token.type = t.type
                     token.text = t.text.encode('UTF-8')
                     self.render(token)
                     is_newline = False
@@ -634,10 +758,13 @@ cdef class IndentProcessor:
 
                 if comment:
                     comment.text += string(b' / ambiguous syntax, previous semicolon is needed')
+                    comment.start = -1
                 else:
                     self.ws(1)
                     amb_comment.type = CTokens.LINE_COMMENT
+                    amb_comment.count = 0
                     amb_comment.text = string(b'-- ambiguous syntax, previous semicolon is needed')
+                    amb_comment.start = -1
                     self._src.push_back(amb_comment)
                     self.ensure_newline()
 
@@ -1342,6 +1469,16 @@ cdef class IndentProcessor:
             self.save()
             if self.parse_field().success:
                 while True:
+                    # a separator followed by a literal field can not fail, no need to backtrack
+                    if self.next_in(self.COMMA_SEMCOL) and self.literal_field_size(1) > 0:
+                        if check_field_list:
+                            self.next_in_rc_cont(self.COMMA_SEMCOL)
+                            self.ws(1)
+                        else:
+                            self.next_in_rc(self.COMMA_SEMCOL)
+                        self.parse_literal_field()
+                        continue
+
                     self.save()
                     # if check_field_list, no space is allowed between COMMA and key
                     if self.next_in(self.COMMA_SEMCOL) and \
@@ -1406,6 +1543,11 @@ cdef class IndentProcessor:
     cdef ParseFieldResult parse_field(self, int n_space_before_assign=-1):
         cdef ParseFieldResult result
         cdef bool space_before_assign
+
+        # fast path for data tables
+        if self.literal_field_size() > 0:
+            return self.parse_literal_field(n_space_before_assign)
+
         space_before_assign = (n_space_before_assign >= 0)
         result.has_assign = False
 
@@ -1446,6 +1588,61 @@ cdef class IndentProcessor:
         result.success = self.failure()
         return result
 
+    cdef int literal_field_size(self, int offset=0):
+        """Return the number of tokens of the field starting at offset if it is
+        made of literals only ('literal', 'name = literal' or '[literal] = literal')
+        and is followed by a field separator or '}', else 0.
+        """
+        cdef int size
+        cdef int type = self._stream.LT(1 + offset).type
+
+        if self.LITERAL.find(type) != self.LITERAL.end():
+            size = 1
+        elif type == CTokens.NAME and \
+                self._stream.LT(2 + offset).type == CTokens.ASSIGN and \
+                self.LITERAL.find(self._stream.LT(3 + offset).type) != self.LITERAL.end():
+            size = 3
+        elif type == CTokens.OBRACK and \
+                self.LITERAL.find(self._stream.LT(2 + offset).type) != self.LITERAL.end() and \
+                self._stream.LT(3 + offset).type == CTokens.CBRACK and \
+                self._stream.LT(4 + offset).type == CTokens.ASSIGN and \
+                self.LITERAL.find(self._stream.LT(5 + offset).type) != self.LITERAL.end():
+            size = 5
+        else:
+            return 0
+
+        if self.FIELD_END.find(self._stream.LT(1 + offset + size).type) != self.FIELD_END.end():
+            return size
+        return 0
+
+    cdef ParseFieldResult parse_literal_field(self, int n_space_before_assign=-1):
+        """Render a field checked with literal_field_size, same as parse_field
+        but without backtracking.
+        """
+        cdef ParseFieldResult result
+        result.success = True
+        result.has_assign = False
+        self._last_expr_type = Expr.EXPR_ATOM
+
+        if self.next_is(CTokens.OBRACK):
+            self.next_rc()  # [
+            self.next_rc()  # key
+            self.next_rc()  # ]
+        elif self.next_is(CTokens.NAME):
+            self.next_rc()
+        else:
+            self.next_rc()  # value
+            return result
+
+        result.assign_position = self.get_column_of_last()
+        if n_space_before_assign >= 0:
+            self.ws(n_space_before_assign)
+
+        self.next_rc()  # =
+        self.next_rc()  # value
+        result.has_assign = True
+        return result
+
     cdef bool parse_field_sep(self):
         self.save()
         if self.next_in_rc(self.COMMA_SEMCOL):
@@ -1459,6 +1656,109 @@ cdef class IndentProcessor:
             return self._level + self._opt.initial_indent_level
 
 
+# '-- @luastyle.skip' in the comments at the top of a file
+SKIP_HEADER = re.compile(r'(?:[ \t]*(?:#!|--)[^\n]*\n|[ \t]*\r?\n)*?[ \t]*--[ \t]*@luastyle\.skip\b')
+
+
+def is_skipped(input):
+    """True if the file header contains the '@luastyle.skip' marker."""
+    return '@luastyle.skip' in input and SKIP_HEADER.match(input) is not None
+
+
+class VerbatimRegions:
+    """
+    Source regions between '-- @luastyle.off' and '-- @luastyle.on' line
+    comments (or the end of file), copied to the output as is.
+
+    Each region is replaced by a placeholder comment before tokenizing,
+    so that it is a single hidden token for the processor, then restored.
+    Markers are only recognized in line comments starting a line, not in
+    long brackets or strings.
+    """
+    # long comments and strings are matched first so that they are skipped
+    SCAN = re.compile(r'''
+        --\[(=*)\[.*?\]\1\]
+        | \[(=*)\[.*?\]\2\]
+        | "(?:\\.|[^"\\\n])*"
+        | '(?:\\.|[^'\\\n])*'
+        | (?P<comment>--[^\r\n]*)
+        ''', re.DOTALL | re.VERBOSE)
+    MARKER = re.compile(r'--[ \t]*@luastyle\.(off|on)\b')
+
+    def __init__(self, input):
+        self._regions = []
+        # placeholder end offsets in text and cumulated length differences
+        self._ends = []
+        self._deltas = []
+        self.text = input
+        # a region runs to the end of file
+        self.unterminated = False
+        if '@luastyle.off' not in input:
+            return
+
+        tag = '@luastyle.verbatim'
+        while tag in input:
+            tag += '_'
+        self._placeholder = re.compile(re.escape('--[[' + tag + ':') + r'(\d+)\]\]')
+
+        chunks = []
+        cursor = 0
+        start = -1
+        delta = 0
+        for kind, marker_start, marker_end in self._markers(input):
+            if kind == 'off' and start < 0:
+                start = marker_start
+            elif kind == 'on' and start >= 0:
+                cursor, delta = self._add(input, chunks, cursor, start, marker_end, tag, delta)
+                start = -1
+        if start >= 0:
+            self.unterminated = True
+            cursor, delta = self._add(input, chunks, cursor, start, len(input), tag, delta)
+        chunks.append(input[cursor:])
+        self.text = ''.join(chunks)
+
+    def _markers(self, input):
+        """Yield (kind, start, end) of the marker comments starting a line."""
+        for token in self.SCAN.finditer(input):
+            if token.group('comment') is None:
+                continue
+            marker = self.MARKER.match(input, token.start())
+            line_start = input.rfind('\n', 0, token.start()) + 1
+            if marker and not input[line_start:token.start()].strip(' \t'):
+                yield marker.group(1), token.start(), token.end()
+
+    def _add(self, input, chunks, cursor, start, end, tag, delta):
+        placeholder = '--[[' + tag + ':' + str(len(self._regions)) + ']]'
+        chunks.append(input[cursor:start])
+        chunks.append(placeholder)
+        self._regions.append(input[start:end])
+        self._ends.append(start - delta + len(placeholder))
+        delta += (end - start) - len(placeholder)
+        self._deltas.append(delta)
+        return end, delta
+
+    def restore(self, output):
+        """Put back the original regions in a text containing placeholders."""
+        if not self._regions:
+            return output
+        return self._placeholder.sub(lambda m: self._regions[int(m.group(1))], output)
+
+    def _offset(self, offset):
+        """Convert an offset in text to an offset in the original input."""
+        i = bisect.bisect_right(self._ends, offset)
+        return offset + self._deltas[i - 1] if i > 0 else offset
+
+    def restore_edits(self, edits):
+        """Convert edits computed on text to edits of the original input."""
+        if not self._regions:
+            return edits
+        restored = []
+        for offset, length, replacement in edits:
+            start = self._offset(offset)
+            restored.append((start, self._offset(offset + length) - start, self.restore(replacement)))
+        return restored
+
+
 class IndentRule:
     """
     This rule indent the code.
@@ -1467,10 +1767,42 @@ class IndentRule:
         self._opt = options
 
     def apply(self, input):
+        if is_skipped(input):
+            return input
+        regions = VerbatimRegions(input)
+
         # tokenize source code
-        stream = ast.get_token_stream(input)
+        stream = ast.get_token_stream(regions.text)
 
         # indent
         processor = IndentProcessor(self._opt, stream)
 
-        return processor.process()
\ No newline at end of file
+        try:
+            return regions.restore(processor.process())
+        except Exception as e:
+            self._unterminated_error(regions, e)
+            raise
+
+    def edits(self, input):
+        """
+        Return the minimal list of (offset, length, replacement) edits
+        that turn input into its formatted version, see apply_edits.
+        """
+        if is_skipped(input):
+            return []
+        regions = VerbatimRegions(input)
+
+        stream = ast.get_token_stream(regions.text)
+        processor = IndentProcessor(self._opt, stream)
+
+        try:
+            return regions.restore_edits(processor.process_edits(regions.text))
+        except Exception as e:
+            self._unterminated_error(regions, e)
+            raise
+
+    def _unterminated_error(self, regions, error):
+        # the usual cause is a region swallowing the end of a block
+        if regions.unterminated:
+            raise Exception(str(error) + ', a @luastyle.off region without @luastyle.on '
+                            'must be at the top level') from error
\ No newline at end of file
@@ -0,0 +1,275 @@
+import unittest
+import io
+import os
+import contextlib
+import tempfile
+from luastyle import indenter
+from luastyle.core import FilesProcessor, StreamProcessor, collect_files, shard_files, parse_shard, merge_stats
+from luastyle.watch import PollingObserver, InotifyObserver, Watcher
+
+
+class StreamProcessorTestCase(unittest.TestCase):
+    def run_stream(self, raw, framing):
+        out = io.BytesIO()
+        errors = StreamProcessor(2, False, indenter.IndentOptions(), framing).run(io.BytesIO(raw), out)
+        return errors, out.getvalue()
+
+    def test_length_framing(self):
+        errors, out = self.run_stream(b'18\nif a then\nb()\nend\n11\nlocal x = (6\ndo end', 'length')
+        self.assertEqual(errors, 1)
+        self.assertEqual(out, b'20\nif a then\n  b()\nend\n!17\nExpecting a chunk6\ndo end')
+
+    def test_nul_framing(self):
+        errors, out = self.run_stream(b'do\nx()\nend\0local x = (\0a = 1', 'nul')
+        self.assertEqual(errors, 1)
+        self.assertEqual(out, b'do\n  x()\nend\0\x15Expecting a chunk\0a = 1\0')
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, self.run_stream, b'6\ndo end12\ndo', 'length')
+        self.assertRaises(ValueError, self.run_stream, b'-1\ndo end', 'length')
+
+    def test_broken_output(self):
+        class BrokenPipe(io.BytesIO):
+            def write(self, data):
+                raise BrokenPipeError(32, 'Broken pipe')
+
+        raw = b'do end\0' * 200
+        processor = StreamProcessor(1, False, indenter.IndentOptions(), 'nul')
+        self.assertRaises(BrokenPipeError, processor.run, io.BytesIO(raw), BrokenPipe())
+
+
+class FilesProcessorTestCase(unittest.TestCase):
+    def run_files(self, sources, output_format='text', large_output_size=None, check=False, fail_fast=False):
+        with tempfile.TemporaryDirectory() as root:
+            files = []
+            for i, source in enumerate(sources):
+                files.append(os.path.join(root, 'f%d.lua' % i))
+                with open(files[-1], 'w') as file:
+                    file.write(source)
+            processor = FilesProcessor(False, 2, False, indenter.IndentOptions(), False, output_format,
+                                       check, fail_fast)
+            if large_output_size is not None:
+                processor.LARGE_OUTPUT_SIZE = large_output_size
+            out = io.BytesIO()
+            report = io.StringIO()
+            with contextlib.redirect_stdout(report):
+                stats = processor.run(files, outstream=out)
+            if check:
+                out = report.getvalue()
+            else:
+                out = out.getvalue().decode('UTF-8')
+            return stats, out.replace(root + os.sep, '')
+
+    def test_ordered_output(self):
+        sources = ['do\nx(%d)\nend' % i for i in range(20)]
+        stats, out = self.run_files(sources)
+        self.assertEqual(stats['processed'], 20)
+        self.assertEqual(out, ''.join('do\n  x(%d)\nend\n' % i for i in range(20)))
+
+    def test_large_output(self):
+        stats, out = self.run_files(['do\nx(1)\nend', 'do\nx(2)\nend'], large_output_size=1)
+        self.assertEqual(out, 'do\n  x(1)\nend\ndo\n  x(2)\nend\n')
+
+    def test_header_output(self):
+        stats, out = self.run_files(['do\nx()\nend', 'local x = (', 'a = 1\n'], 'header')
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(out, '==> f0.lua <==\ndo\n  x()\nend\n==> f2.lua <==\na = 1\n')
+
+    def test_diff_output(self):
+        stats, out = self.run_files(['do\nx()\nend\n', 'a = 1\n'], 'diff')
+        self.assertEqual(out, '--- f0.lua\n+++ f0.lua\n@@ -1,3 +1,3 @@\n do\n-x()\n+  x()\n end\n')
+
+    def test_edits_output(self):
+        stats, out = self.run_files(['do\nx()\nend\n', 'a = 1\n'], 'edits')
+        self.assertEqual(out, '{"file": "f0.lua", "edits": [[3, 0, "  "]]}\n{"file": "f1.lua", "edits": []}\n')
+
+    def test_broken_output(self):
+        class BrokenPipe(io.BytesIO):
+            def write(self, data):
+                raise BrokenPipeError(32, 'Broken pipe')
+
+        with tempfile.TemporaryDirectory() as root:
+            files = [os.path.join(root, 'f%d.lua' % i) for i in range(20)]
+            for filepath in files:
+                with open(filepath, 'w') as file:
+                    file.write('do end')
+            processor = FilesProcessor(False, 2, False, indenter.IndentOptions(), False)
+            report = io.StringIO()
+            with contextlib.redirect_stderr(report):
+                self.assertRaises(BrokenPipeError, processor.run, files, outstream=BrokenPipe())
+            self.assertEqual(report.getvalue(), '')
+
+    def test_config_lookup(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'a', 'b'))
+            os.makedirs(os.path.join(root, 'c'))
+            with open(os.path.join(root, 'a', '.luastylerc'), 'w') as file:
+                file.write('{"indent_size": 4}')
+            with open(os.path.join(root, 'a', 'b', '.luastylerc'), 'w') as file:
+                file.write('{"indent_char": 9, "indent_size": 1}')
+            with open(os.path.join(root, 'c', '.luastylerc'), 'w') as file:
+                file.write('{"indent_size": 4}')
+            files = [os.path.join(root, path) for path in ['f.lua', 'a/f.lua', 'a/b/f.lua', 'c/f.lua']]
+            for filepath in files:
+                with open(filepath, 'w') as file:
+                    file.write('do\nx()\nend')
+
+            processor = FilesProcessor(False, 2, False, indenter.IndentOptions(), False, config_lookup=True)
+            self.assertEqual(processor.resolve(files), [0, 1, 2, 1])
+            out = io.BytesIO()
+            processor.run(files, outstream=out)
+            self.assertEqual(out.getvalue(), b'do\n  x()\nend\ndo\n    x()\nend\ndo\n\tx()\nend\ndo\n    x()\nend\n')
+
+            # command line options take precedence
+            options = indenter.IndentOptions()
+            options.indent_size = 3
+            processor = FilesProcessor(False, 2, False, options, False, config_lookup=True,
+                                       config_overrides={'indent_size': 3})
+            out = io.BytesIO()
+            processor.run(files, outstream=out)
+            self.assertEqual(out.getvalue(), b'do\n   x()\nend\ndo\n   x()\nend\ndo\n\t\t\tx()\nend\ndo\n   x()\nend\n')
+
+    def test_config_lookup_errors(self):
+        with tempfile.TemporaryDirectory() as root:
+            files = []
+            for i, rc in enumerate(['{"indent_size": "x"}', '{"indent_char": " "}', '[1]', '{', None]):
+                os.makedirs(os.path.join(root, 'd%d' % i, 'sub'))
+                if rc is not None:
+                    with open(os.path.join(root, 'd%d' % i, '.luastylerc'), 'w') as file:
+                        file.write(rc)
+                files.append(os.path.join(root, 'd%d' % i, 'sub', 'f.lua'))
+                with open(files[-1], 'w') as file:
+                    file.write('do\nx()\nend')
+
+            processor = FilesProcessor(False, 2, False, indenter.IndentOptions(), False, config_lookup=True)
+            errors = []
+            self.assertEqual(processor.resolve(files, errors), [None, None, None, None, 0])
+            self.assertEqual(len(errors), 4)
+            out = io.BytesIO()
+            with contextlib.redirect_stderr(io.StringIO()):
+                stats = processor.run(files, outstream=out)
+            self.assertEqual((stats['processed'], stats['errors']), (1, 4))
+            self.assertEqual(out.getvalue(), b'do\n  x()\nend\n')
+
+            # fixed files are read again after a reload
+            with open(os.path.join(root, 'd2', '.luastylerc'), 'w') as file:
+                file.write('{"indent_size": 4}')
+            processor.reload_config()
+            self.assertEqual(processor.resolve(files[2:]), [1, None, 0])
+
+    def test_check(self):
+        stats, out = self.run_files(['do\n  x()\nend\n', 'do\n  x()\ny()\nend\n'], check=True)
+        self.assertEqual((stats['processed'], stats['changed']), (2, 1))
+        self.assertEqual(out, 'f1.lua:3: would be reformatted\n')
+
+    def test_check_fail_fast(self):
+        stats, out = self.run_files(['do\nx()\nend\n'] * 20, check=True, fail_fast=True)
+        self.assertEqual((stats['processed'], stats['changed']), (1, 1))
+        with contextlib.redirect_stderr(io.StringIO()):
+            stats, out = self.run_files(['local x = ('] * 20, check=True, fail_fast=True)
+        self.assertEqual((stats['processed'], stats['errors']), (0, 1))
+
+
+class ShardTestCase(unittest.TestCase):
+    def test_shard_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            for i, size in enumerate([50, 10, 40, 20, 30, 30]):
+                with open(os.path.join(root, 'f%d.lua' % i), 'w') as file:
+                    file.write('a' * size)
+            files = collect_files([root], ['lua'])
+            self.assertEqual(files, sorted(files))
+
+            shards = [shard_files(files, i, 3) for i in range(1, 4)]
+            self.assertEqual(shards, [shard_files(list(reversed(files)), i, 3) for i in range(1, 4)])
+            self.assertEqual(sorted(sum(shards, [])), files)
+            loads = [sum(os.path.getsize(f) for f in shard) for shard in shards]
+            self.assertEqual(loads, [60, 60, 60])
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/4'), (2, 4))
+        self.assertRaises(ValueError, parse_shard, '0/4')
+        self.assertRaises(ValueError, parse_shard, '2')
+
+    def test_merge_stats(self):
+        stats = merge_stats([{'files': 2, 'processed': 1, 'errors': 1, 'lines': 10, 'time': 1.0},
+                             {'files': 3, 'processed': 3, 'errors': 0, 'lines': 5, 'time': 0.5}])
+        self.assertEqual(stats, {'files': 5, 'processed': 4, 'changed': 0, 'errors': 1, 'lines': 15, 'time': 1.5})
+
+
+class PollingObserverTestCase(unittest.TestCase):
+    def test_changes(self):
+        with tempfile.TemporaryDirectory() as root:
+            filepath = os.path.join(root, 'a.lua')
+            with open(filepath, 'w') as file:
+                file.write('do end')
+            observer = PollingObserver([root], ['lua'], interval=0.01)
+            self.assertEqual(observer.wait(), set())
+
+            with open(filepath, 'w') as file:
+                file.write('do\nend')
+            with open(os.path.join(root, 'b.txt'), 'w') as file:
+                file.write('ignored')
+            self.assertEqual(observer.wait(), {filepath})
+
+
+class InotifyObserverTestCase(unittest.TestCase):
+    def test_changes(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'src'))
+            filepath = os.path.join(root, 'a.lua')
+            try:
+                observer = InotifyObserver([os.path.join(root, 'src'), filepath], ['lua'])
+            except OSError:
+                self.skipTest('inotify not available')
+            try:
+                for name in ['a.lua', 'b.lua', 'src/c.lua', 'src/d.txt']:
+                    with open(os.path.join(root, name), 'w') as file:
+                        file.write('do end')
+                self.assertEqual(observer.wait(1.0), {filepath, os.path.join(root, 'src', 'c.lua')})
+                self.assertEqual(observer.wait(0.01), set())
+            finally:
+                observer.close()
+
+
+class WatcherTestCase(unittest.TestCase):
+    class ScriptedObserver:
+        def __init__(self, events):
+            self.events = list(events)
+
+        def wait(self, timeout=None):
+            return self.events.pop(0)
+
+    def test_debounce(self):
+        watcher = Watcher(None, [], ['lua'], 1)
+        observer = self.ScriptedObserver([set(), {'a.lua'}, {'a.lua'}, {'b.lua'}, set(), {'c.lua'}])
+        self.assertEqual(watcher._next_batch(observer), {'a.lua', 'b.lua'})
+        self.assertEqual(observer.events, [{'c.lua'}])
+
+    def test_own_writes_ignored(self):
+        with tempfile.TemporaryDirectory() as root:
+            filepath = os.path.join(root, 'a.lua')
+            with open(filepath, 'w') as file:
+                file.write('do\nx()\nend\n')
+            processor = FilesProcessor(True, 1, False, indenter.IndentOptions(), False)
+            watcher = Watcher(processor, [filepath], ['lua'], 1)
+
+            # the path reported by an observer may be spelled differently
+            event = os.path.join(root, '.', 'a.lua')
+            files = watcher._changed({event})
+            self.assertEqual(files, [filepath])
+            watcher._process(files, None)
+            with open(filepath) as file:
+                self.assertEqual(file.read(), 'do\n  x()\nend\n')
+            self.assertEqual(watcher._changed({event}), [])
+
+            with open(filepath, 'w') as file:
+                file.write('do\ny()\nend\n')
+            self.assertEqual(watcher._changed({event}), [filepath])
+
+            # a save made after the file was processed is not taken for its output
+            digests = {}
+            processor.run([filepath], digests=digests)
+            with open(filepath, 'w') as file:
+                file.write('do\nz()\nend\n')
+            watcher._remember([filepath], digests)
+            self.assertEqual(watcher._changed({event}), [filepath])
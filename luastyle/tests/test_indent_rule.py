@@ -24,6 +24,8 @@ class IndentRuleTestCase(unittest.TestCase):
         print(formatted)
         self.assertEqual(formatted, exp)
         self.assertTrue(check_lua_bytecode(raw, formatted))
+        edits = indenter.IndentRule(options).edits(raw)
+        self.assertEqual(indenter.apply_edits(raw, edits), exp)
 
     def test_no_indent(self):
         self.setupTest('no_indent')
@@ -54,6 +56,39 @@ class IndentRuleTestCase(unittest.TestCase):
         options.check_field_list = True
         self.setupTest('table', options)
 
+    def test_data_table(self):
+        options = indenter.IndentOptions()
+        options.check_field_list = True
+        options.space_around_op = True
+        self.setupTest('data_table', options)
+
+    def test_verbatim(self):
+        options = indenter.IndentOptions()
+        options.check_field_list = True
+        self.setupTest('verbatim', options)
+
+    def test_verbatim_markers(self):
+        options = indenter.IndentOptions()
+        options.skip_semi_colon = True
+        # markers in long strings or comments are ignored
+        for raw in ['local s = [[\n  -- @luastyle.off\n  raw ]]\ndo\nx();\nend\n',
+                    '--[==[\n-- @luastyle.off\n]==]\ndo\nx();\nend\n']:
+            self.assertEqual(indenter.IndentRule(options).apply(raw), raw[:raw.index('do')] + 'do\n  x()\nend\n')
+        # a region running to the end of file must be at the top level
+        self.assertEqual(indenter.IndentRule(options).apply('x();\n-- @luastyle.off\ny();\n'),
+                         'x()\n-- @luastyle.off\ny();\n')
+        self.assertRaisesRegex(Exception, 'top level', indenter.IndentRule(options).apply,
+                               'function f()\n-- @luastyle.off\nx()\nend\n')
+
+    def test_skip(self):
+        raw = '#!/usr/bin/lua\n-- generated file\n\n-- @luastyle.skip\nif a then\nb()\nend\n'
+        self.assertEqual(indenter.IndentRule(indenter.IndentOptions()).apply(raw), raw)
+        self.assertEqual(indenter.IndentRule(indenter.IndentOptions()).edits(raw), [])
+        # only in the file header
+        raw = 'if a then\n-- @luastyle.skip\nb()\nend\n'
+        self.assertEqual(indenter.IndentRule(indenter.IndentOptions()).apply(raw),
+                         'if a then\n  -- @luastyle.skip\n  b()\nend\n')
+
     def test_while(self):
         self.setupTest('while')
 
@@ -156,6 +191,19 @@ class IndentRuleTestCase(unittest.TestCase):
         formatted = indenter.IndentRule(options).apply(src)
         self.assertEqual(formatted, expected)
 
+    def test_indent_with_tabs_option(self):
+        src = textwrap.dedent('''\
+            do
+              local a
+            end
+            ''')
+
+        options = indenter.IndentOptions()
+        options.indent_with_tabs = True
+        options.initial_indent_level = 1
+        formatted = indenter.IndentRule(options).apply(src)
+        self.assertEqual(formatted, '\tdo\n\t\tlocal a\n\tend\n')
+
     def test_func_cont_line_level_option(self):
         src = '''\
             function foo(a, b, 
@@ -423,3 +471,11 @@ class IndentRuleTestCase(unittest.TestCase):
     # #########################################################################
     def test_cont_int_1(self):
         self.setupTest('cont_int_1')
+
+    def test_edits(self):
+        options = indenter.IndentOptions()
+        options.check_field_list = True
+        raw = 'local t = {1,2}\nif a then\nb()\nend\n'
+        edits = indenter.IndentRule(options).edits(raw)
+        self.assertEqual(edits, [(13, 0, ' '), (26, 0, '  ')])
+        self.assertEqual(indenter.IndentRule(options).edits(indenter.apply_edits(raw, edits)), [])
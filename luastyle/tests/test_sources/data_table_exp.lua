@@ -0,0 +1,31 @@
+local data = {
+  name = "data", ["key"]="value", [1] = 0x10,
+  version=1.5, enabled = true, disabled=false, empty = nil,
+  'a', "b", [[long]],
+  -- comment before a field
+  nested = {
+    { id = 1, label = "one" },
+    { id = 2, label = "two" }, 
+    {
+      id = 3;
+      label = "three" ; -- trailing comment
+    }
+  },
+  mixed = {x = 1, y = f(2), z = 3 + 4, w = -5, v = "s" .. "t", u = 7},
+  list = {1, 2, 3, 4, 5, 6, 7, 8, 9, 10},
+  last = 'end'
+}
+
+local t = {
+  -- @luastyle.disable
+  1,    2,    4,
+  8,    16,   32
+}
+
+local aligned = {
+  a = 1,
+  bbb = 2,
+  cc = "three",
+  [4] = 4,
+  dddd = {e = 5},
+}
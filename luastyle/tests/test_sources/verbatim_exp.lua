@@ -0,0 +1,26 @@
+local function f()
+  local a = 1
+  -- @luastyle.off
+  local   matrix = {
+      1, 0, 0,
+      0, 1, 0,
+  }
+    -- @luastyle.on
+  if a then
+    return matrix
+  end
+end
+
+local t = {
+  -- @luastyle.off: generated
+  1,2,
+    3,4,
+-- @luastyle.on
+}
+
+do
+  print("a")
+end
+-- @luastyle.off
+print(  "b"  )
+  if b then print(  "c"  ) end
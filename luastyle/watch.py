@@ -0,0 +1,245 @@
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import hashlib
+import ctypes
+import ctypes.util
+
+from luastyle.core import collect_files, has_extension, create_executor
+
+
+# inotify constants, see <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+
+class InotifyObserver:
+    """Report modified files using Linux inotify.
+
+    Every directory given (and its sub-directories) is watched, explicitly
+    given files are watched through their parent directory.
+    """
+    _EVENT = struct.Struct('iIII')
+    _MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, paths, extensions):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or libc_name is None:
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self._extensions = extensions
+        # watch descriptor -> (directory, is part of a watched tree)
+        self._wd_to_dir = {}
+        self._files = set()  # explicitly watched files
+        for path in paths:
+            if os.path.isdir(path):
+                self._add_tree(path)
+            else:
+                self._files.add(os.path.normpath(path))
+                self._add_dir(os.path.dirname(path) or '.', False)
+
+    def _add_dir(self, path, recursive):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self._MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on ' + path)
+        # the same directory can be watched as a tree and as a file parent
+        recursive = recursive or self._wd_to_dir.get(wd, (path, False))[1]
+        self._wd_to_dir[wd] = (path, recursive)
+
+    def _add_tree(self, path):
+        for root, subdirs, files in os.walk(path):
+            self._add_dir(root, True)
+
+    def wait(self, timeout=None):
+        """Wait for events, return a set of modified paths.
+
+        Return None if events were lost and a full rescan is needed.
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed = set()
+        data = self._read()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if wd not in self._wd_to_dir:
+                continue
+            directory, recursive = self._wd_to_dir[wd]
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if recursive:
+                    self._add_tree(path)
+                    # files may have been created before the watch was set
+                    changed.update(collect_files([path], self._extensions))
+            elif (recursive and has_extension(name, self._extensions)) or os.path.normpath(path) in self._files:
+                changed.add(path)
+        return changed
+
+    def _read(self):
+        chunks = []
+        while True:
+            try:
+                chunks.append(os.read(self._fd, 65536))
+            except BlockingIOError:
+                break
+        return b''.join(chunks)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingObserver:
+    """Report modified files by polling their modification time and size.
+    """
+    def __init__(self, paths, extensions, interval=1.0):
+        self._paths = paths
+        self._extensions = extensions
+        self._interval = interval
+        self._stats = self._scan()
+
+    def _scan(self):
+        stats = {}
+        for filepath in collect_files(self._paths, self._extensions):
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            stats[filepath] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def wait(self, timeout=None):
+        """Wait for the next poll, return a set of modified paths.
+        """
+        time.sleep(self._interval if timeout is None else min(timeout, self._interval))
+        stats = self._scan()
+        changed = set(path for path, stat in stats.items() if self._stats.get(path) != stat)
+        self._stats = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+def create_observer(paths, extensions, polling=False):
+    """Create an inotify observer, or a polling one if inotify is not available.
+    """
+    if not polling:
+        try:
+            return InotifyObserver(paths, extensions)
+        except OSError:
+            pass
+    return PollingObserver(paths, extensions)
+
+
+class Watcher:
+    """Reformat files as they change.
+
+    After an initial pass, the process pool is kept alive and only files
+    whose content changed since the last pass are processed again. Events
+    are debounced so a burst of writes is formatted once, and a file written
+    back by the formatter is not processed again as its content is known.
+    Files are identified by their normalized path, observers may report
+    another spelling of the path given on the command line.
+    """
+    def __init__(self, processor, paths, extensions, jobs, debounce=0.2, polling=False):
+        self._processor = processor
+        self._paths = paths
+        self._extensions = extensions
+        self._jobs = jobs
+        self._debounce = debounce
+        self._polling = polling
+        self._digests = {}
+
+    def _digest(self, filepath):
+        try:
+            with open(filepath, 'rb') as file:
+                return hashlib.sha1(file.read()).digest()
+        except OSError:
+            return None
+
+    def _remember(self, files, digests):
+        """Remember the digests of files computed by the processor.
+
+        The disk is not read again, a save made since the file was processed
+        is then seen as a change.
+        """
+        digests = dict((os.path.normpath(filepath), digest) for filepath, digest in digests.items())
+        for filepath in files:
+            filepath = os.path.normpath(filepath)
+            if filepath in digests:
+                self._digests[filepath] = digests[filepath]
+            else:
+                # failed, processed again on its next change
+                self._digests.pop(filepath, None)
+
+    def _process(self, files, executor):
+        digests = {}
+        self._processor.run(files, executor, digests=digests)
+        self._remember(files, digests)
+
+    def _changed(self, files):
+        changed = []
+        for filepath in sorted(set(os.path.normpath(filepath) for filepath in files)):
+            digest = self._digest(filepath)
+            if digest is None:
+                self._digests.pop(filepath, None)
+            elif self._digests.get(filepath) != digest:
+                changed.append(filepath)
+        return changed
+
+    def _next_batch(self, observer):
+        """Block until files changed, then collect events until the burst settles.
+        """
+        changed = set()
+        while not changed:
+            changed = observer.wait()
+            if changed is None:
+                return set(collect_files(self._paths, self._extensions))
+        while True:
+            more = observer.wait(self._debounce)
+            if more is None:
+                return set(collect_files(self._paths, self._extensions))
+            if not more:
+                return changed
+            changed |= more
+
+    def run(self):
+        files = collect_files(self._paths, self._extensions)
+        # set the observer first to not miss changes made during the initial pass
+        observer = create_observer(self._paths, self._extensions, self._polling)
+        try:
+            # resolve the known directories before the workers receive the option sets
+            self._processor.resolve(files)
+            with create_executor(self._jobs, self._processor.verbose, self._processor) as executor:
+                self._process(files, executor)
+                while True:
+                    files = self._changed(self._next_batch(observer))
+                    if files:
+                        # .luastylerc files may have been edited meanwhile
+                        self._processor.reload_config()
+                        self._process(files, executor)
+        finally:
+            observer.close()